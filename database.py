@@ -1,6 +1,9 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from datetime import datetime
 import os
+import uuid
+import itertools
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,6 +13,10 @@ MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "codecollab")
 SPACE_EXPIRY_HOURS = int(os.getenv("SPACE_EXPIRY_HOURS", "24"))
 
+# Identifies this process's writes so it can skip its own change stream events
+WORKER_ID = uuid.uuid4().hex
+_write_seq = itertools.count()
+
 # Global database client
 client: AsyncIOMotorClient = None
 database = None
@@ -17,7 +24,15 @@ database = None
 
 async def connect_to_mongodb():
     global client, database
-    client = AsyncIOMotorClient(MONGODB_URL)
+    client = AsyncIOMotorClient(
+        MONGODB_URL,
+        maxPoolSize=50,
+        minPoolSize=10,
+        compressors="zstd",
+        retryWrites=True,
+        maxIdleTimeMS=60000,
+        serverSelectionTimeoutMS=3000
+    )
     database = client[DATABASE_NAME]
     print(f"✅ Connected to MongoDB: {DATABASE_NAME}")
     await database.spaces.create_index("space_id", unique=True)
@@ -48,8 +63,7 @@ async def create_space(space_id: str, language: str = "python", initial_code: st
         "code": initial_code,
         "language": language,
         "created_at": datetime.utcnow(),
-        "last_updated": datetime.utcnow(),
-        "active_users": []
+        "last_updated": datetime.utcnow()
     }
     await database.spaces.insert_one(space_document)
     return space_document
@@ -60,62 +74,52 @@ async def get_space(space_id: str):
     return await database.spaces.find_one({"space_id": space_id})
 
 
-async def update_space_code(space_id: str, code: str):
-    """Update code in a space"""
-    result = await database.spaces.update_one(
-        {"space_id": space_id},
-        {
-            "$set": {
-                "code": code,
-                "last_updated": datetime.utcnow()
-            }
-        }
-    )
-    return result.modified_count > 0
-
-
-async def update_space_language(space_id: str, language: str):
-    """Update language in a space"""
-    result = await database.spaces.update_one(
-        {"space_id": space_id},
-        {
-            "$set": {
-                "language": language,
-                "last_updated": datetime.utcnow()
-            }
-        }
-    )
-    return result.modified_count > 0
+async def space_exists(space_id: str):
+    """Check whether a space exists without fetching the document"""
+    return await database.spaces.count_documents({"space_id": space_id}, limit=1) > 0
 
 
-async def delete_space(space_id: str):
-    """Delete a space"""
-    result = await database.spaces.delete_one({"space_id": space_id})
-    return result.deleted_count > 0
+async def bulk_update_spaces(codes: dict, languages: dict):
+    """Apply pending code/language updates for many spaces in one round trip"""
+    now = datetime.utcnow()
+    # Unique per flush so the field always shows up in change stream updatedFields
+    writer = f"{WORKER_ID}:{next(_write_seq)}"
+    operations = []
+    for space_id in codes.keys() | languages.keys():
+        fields = {"last_updated": now, "last_writer": writer}
+        if space_id in codes:
+            fields["code"] = codes[space_id]
+        if space_id in languages:
+            fields["language"] = languages[space_id]
+        operations.append(UpdateOne({"space_id": space_id}, {"$set": fields}))
+    if not operations:
+        return 0
+    result = await database.spaces.bulk_write(operations, ordered=False)
+    return result.modified_count
 
 
-async def cleanup_expired_spaces():
-    """Delete spaces older than SPACE_EXPIRY_HOURS"""
-    expiry_time = datetime.utcnow() - timedelta(hours=SPACE_EXPIRY_HOURS)
-    result = await database.spaces.delete_many({
-        "created_at": {"$lt": expiry_time}
-    })
-    if result.deleted_count > 0:
-        print(f"🧹 Cleaned up {result.deleted_count} expired spaces")
-    return result.deleted_count
+def is_own_write(last_writer: str) -> bool:
+    """Check whether a last_writer value was written by this process"""
+    return last_writer.partition(":")[0] == WORKER_ID
 
 
-async def add_user_to_space(space_id: str, user_id: str):
-    """Add a user to the active users list"""
-    await database.spaces.update_one(
-        {"space_id": space_id},
-        {"$addToSet": {"active_users": user_id}}
-    )
+async def supports_change_streams():
+    """Change streams need a replica set or a sharded cluster"""
+    hello = await client.admin.command("hello")
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
 
 
-async def remove_user_from_space(space_id: str, user_id: str):
-    """Remove a user from the active users list"""
-    await database.spaces.update_one(
-        {"space_id": space_id},
-        {"$pull": {"active_users": user_id}}
+def watch_space_updates(resume_after=None):
+    """Open a change stream of space updates, optionally resuming after a token"""
+    return database.spaces.watch(
+        [{"$match": {"operationType": "update"}}],
+        full_document="updateLookup",
+        resume_after=resume_after
     )
+
+
+async def delete_space(space_id: str):
+    """Delete a space"""
+    result = await database.spaces.delete_one({"space_id": space_id})
+    return result.deleted_count > 0
+
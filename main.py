@@ -1,58 +1,72 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
 import asyncio
 import uuid
 import os
-import time
 from datetime import datetime
-from typing import Dict, Set
-import json
+from typing import Dict, Set, Tuple
+import orjson
+import msgspec
+from cachetools import TTLCache
 from starlette.middleware.gzip import GZipMiddleware
+from pymongo.errors import OperationFailure
 
 from database import (
     connect_to_mongodb,
     close_mongodb_connection,
     create_space,
     get_space,
-    update_space_code,
-    update_space_language,
+    space_exists,
+    bulk_update_spaces,
     delete_space,
-    cleanup_expired_spaces,
-    add_user_to_space,
-    remove_user_from_space
+    watch_space_updates,
+    supports_change_streams,
+    is_own_write
 )
 from models import SpaceCreate, SpaceResponse, CodeUpdate
 
 # Environment variables
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
-CLEANUP_INTERVAL_HOURS = int(os.getenv("CLEANUP_INTERVAL_HOURS", "1"))
+_INVITE_PREFIX = FRONTEND_URL + "/space/"
+FLUSH_INTERVAL_MS = int(os.getenv("FLUSH_INTERVAL_MS", "500"))
+SPACE_CACHE_TTL_SECONDS = int(os.getenv("SPACE_CACHE_TTL_SECONDS", "60"))
+CURSOR_BATCH_INTERVAL_MS = int(os.getenv("CURSOR_BATCH_INTERVAL_MS", "33"))
 
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        self.active_connections: Dict[str, Dict[WebSocket, None]] = {}
         self.user_ids: Dict[WebSocket, str] = {}
-        self.last_db_write: Dict[str, float] = {}
+        self.background_tasks: Set[asyncio.Task] = set()
+        self.pending_code: Dict[str, str] = {}
+        self.pending_lang: Dict[str, str] = {}
+        self.flushing_code: Dict[str, str] = {}
+        self.flushing_lang: Dict[str, str] = {}
+        self.flush_count = 0
+        self.space_cache: TTLCache = TTLCache(maxsize=10000, ttl=SPACE_CACHE_TTL_SECONDS)
+        self.space_snapshot_bytes: Dict[str, bytes] = {}
+        self.pending_cursors: Dict[Tuple[str, str], dict] = {}
+        self.last_language: Dict[str, str] = {}
 
     async def connect(self, websocket: WebSocket, space_id: str, user_id: str):
         await websocket.accept()
-        if space_id not in self.active_connections:
-            self.active_connections[space_id] = set()
-        self.active_connections[space_id].add(websocket)
+        self.active_connections.setdefault(space_id, {})[websocket] = None
         self.user_ids[websocket] = user_id
-        await add_user_to_space(space_id, user_id)
         print(f"✅ User {user_id} connected to space {space_id}")
 
     async def disconnect(self, websocket: WebSocket, space_id: str):
         if space_id in self.active_connections:
-            self.active_connections[space_id].discard(websocket)
+            self.active_connections[space_id].pop(websocket, None)
             if not self.active_connections[space_id]:
                 del self.active_connections[space_id]
+                self.space_snapshot_bytes.pop(space_id, None)
+                self.last_language.pop(space_id, None)
         
         user_id = self.user_ids.pop(websocket, None)
         if user_id:
-            await remove_user_from_space(space_id, user_id)
+            self.pending_cursors.pop((space_id, user_id), None)
             print(f"❌ User {user_id} disconnected from space {space_id}")
 
     async def broadcast(self, space_id: str, message: dict, exclude: WebSocket = None):
@@ -60,21 +74,70 @@ class ConnectionManager:
         if space_id not in self.active_connections:
             return
         
-        message_json = json.dumps(message)
-        dead_connections = set()
-        
-        for connection in self.active_connections[space_id]:
-            if connection == exclude:
-                continue
-            try:
-                await connection.send_text(message_json)
-            except Exception as e:
-                print(f"Error broadcasting to connection: {e}")
-                dead_connections.add(connection)
+        payload = orjson.dumps(message)
+        targets = [c for c in self.active_connections[space_id] if c is not exclude]
+        results = await asyncio.gather(
+            *(c.send_bytes(payload) for c in targets),
+            return_exceptions=True
+        )
         
-        # Clean up dead connections
-        for dead_conn in dead_connections:
-            await self.disconnect(dead_conn, space_id)
+        # Clean up dead connections without blocking the sender
+        for connection, result in zip(targets, results):
+            if isinstance(result, Exception):
+                print(f"Error broadcasting to connection: {result}")
+                task = asyncio.create_task(self.disconnect(connection, space_id))
+                # Hold a reference so the task isn't garbage-collected mid-flight
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+
+    def cache_space(self, space: dict) -> dict:
+        """Remember the current state of a space for fast WebSocket connects"""
+        space_id = space["space_id"]
+        # Edits not yet written to MongoDB take precedence over the fetched document
+        cached = {
+            "space_id": space_id,
+            "code": self.pending_code.get(
+                space_id, self.flushing_code.get(space_id, space["code"])
+            ),
+            "language": self.latest_language(space_id, space["language"])
+        }
+        self.space_cache[space_id] = cached
+        self.space_snapshot_bytes.pop(space_id, None)
+        return cached
+
+    def latest_language(self, space_id: str, stored: str) -> str:
+        """Language of a space including changes not yet written to MongoDB"""
+        return self.pending_lang.get(space_id, self.flushing_lang.get(space_id, stored))
+
+    def update_cached_space(self, space_id: str, **fields):
+        """Apply an edit to a cached space, if it is cached"""
+        self.space_snapshot_bytes.pop(space_id, None)
+        cached = self.space_cache.get(space_id)
+        if cached is not None:
+            cached.update(fields)
+            # Re-insert so rooms being edited don't expire
+            self.space_cache[space_id] = cached
+
+    def init_message(self, space: dict, user_id: str) -> bytes:
+        """Build the init payload, reusing the serialized code/language of the space"""
+        space_id = space["space_id"]
+        prefix = self.space_snapshot_bytes.get(space_id)
+        if prefix is None:
+            # Serialize the shared fields once and drop the closing brace
+            prefix = orjson.dumps({
+                "type": "init",
+                "space_id": space_id,
+                "code": space["code"],
+                "language": space["language"]
+            })[:-1]
+            # Only reuse snapshots of the live cached state, never of a stale copy
+            if self.space_cache.get(space_id) is space:
+                self.space_snapshot_bytes[space_id] = prefix
+        return b"%s,\"user_id\":%s,\"active_users\":%d}" % (
+            prefix,
+            orjson.dumps(user_id),
+            self.get_active_users(space_id)
+        )
 
     def get_active_users(self, space_id: str) -> int:
         """Get count of active users in a space"""
@@ -86,12 +149,140 @@ class ConnectionManager:
 manager = ConnectionManager()
 
 
-# Background task for cleanup
-async def periodic_cleanup():
-    """Background task to clean up expired spaces"""
+async def flush_pending_writes():
+    """Write the latest code/language of every dirty space in a single bulk_write"""
+    if not manager.pending_code and not manager.pending_lang:
+        return
+    codes, manager.pending_code = manager.pending_code, {}
+    languages, manager.pending_lang = manager.pending_lang, {}
+    # Keep the in-flight batch visible to cache_space until the write settles
+    manager.flushing_code, manager.flushing_lang = codes, languages
+    try:
+        await bulk_update_spaces(codes, languages)
+        manager.flush_count += 1
+    except asyncio.CancelledError:
+        requeue_pending_writes(codes, languages)
+        raise
+    except Exception as e:
+        print(f"Error flushing pending writes: {e}")
+        requeue_pending_writes(codes, languages)
+    finally:
+        manager.flushing_code, manager.flushing_lang = {}, {}
+
+
+async def fetch_space(space_id: str):
+    """Load a space from MongoDB, re-reading if a flush completed mid-read"""
     while True:
-        await asyncio.sleep(CLEANUP_INTERVAL_HOURS * 3600)  # Convert hours to seconds
-        await cleanup_expired_spaces()
+        flushes = manager.flush_count
+        space = await get_space(space_id)
+        if not space or manager.flush_count == flushes:
+            return space
+
+
+def requeue_pending_writes(codes: dict, languages: dict):
+    """Put a failed batch back without overwriting edits queued since"""
+    codes.update(manager.pending_code)
+    manager.pending_code = codes
+    languages.update(manager.pending_lang)
+    manager.pending_lang = languages
+
+
+async def flush_pending_cursors():
+    """Broadcast the latest cursor of every user as one batch per space"""
+    if not manager.pending_cursors:
+        return
+    cursors, manager.pending_cursors = manager.pending_cursors, {}
+    batches: Dict[str, list] = {}
+    for (space_id, user_id), cursor_position in cursors.items():
+        batches.setdefault(space_id, []).append({
+            "user_id": user_id,
+            "cursor_position": cursor_position
+        })
+    await asyncio.gather(*(
+        manager.broadcast(space_id, {"type": "cursor_batch", "cursors": batch})
+        for space_id, batch in batches.items()
+    ))
+
+
+# Background task for batched cursor broadcasts
+async def periodic_cursor_flush():
+    """Background task to broadcast cursor moves at most every CURSOR_BATCH_INTERVAL_MS"""
+    while True:
+        await asyncio.sleep(CURSOR_BATCH_INTERVAL_MS / 1000)
+        try:
+            await flush_pending_cursors()
+        except Exception as e:
+            print(f"Error broadcasting cursor batch: {e}")
+
+
+# Background task for coalesced DB writes
+async def periodic_flush():
+    """Background task to persist pending edits every FLUSH_INTERVAL_MS"""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL_MS / 1000)
+        await flush_pending_writes()
+
+
+# MongoDB error codes for change streams
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+async def relay_space_change(change: dict):
+    """Forward one space update written by another worker to local clients"""
+    updated = change["updateDescription"]["updatedFields"]
+    if is_own_write(updated.get("last_writer", "")):
+        return
+    space = change.get("fullDocument")
+    if not space:
+        return
+    
+    space_id = space["space_id"]
+    if "code" in updated:
+        manager.update_cached_space(space_id, code=updated["code"])
+        await manager.broadcast(
+            space_id,
+            {"type": "code_change", "code": updated["code"], "user_id": None}
+        )
+    if "language" in updated:
+        manager.update_cached_space(space_id, language=updated["language"])
+        if space_id in manager.active_connections:
+            manager.last_language[space_id] = updated["language"]
+        await manager.broadcast(
+            space_id,
+            {"type": "language_change", "language": updated["language"], "user_id": None}
+        )
+
+
+# Background task relaying other workers' edits to local connections
+async def watch_spaces():
+    """Forward code/language updates written by other workers to local clients"""
+    checked = False
+    resume_token = None
+    delay = 1
+    while True:
+        try:
+            if not checked:
+                if not await supports_change_streams():
+                    print("⚠️ MongoDB is not a replica set; cross-worker sync disabled")
+                    return
+                checked = True
+            async with watch_space_updates(resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    delay = 1
+                    await relay_space_change(change)
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_NOT_SUPPORTED:
+                print(f"⚠️ Space change stream unavailable: {e}")
+                return
+            if e.code == CHANGE_STREAM_HISTORY_LOST:
+                resume_token = None
+            print(f"Space change stream error, retrying in {delay}s: {e}")
+        except Exception as e:
+            print(f"Space change stream error, retrying in {delay}s: {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
 
 
 @asynccontextmanager
@@ -99,12 +290,22 @@ async def lifespan(app: FastAPI):
     """Lifespan events for startup and shutdown"""
     # Startup
     await connect_to_mongodb()
-    cleanup_task = asyncio.create_task(periodic_cleanup())
+    flush_task = asyncio.create_task(periodic_flush())
+    cursor_task = asyncio.create_task(periodic_cursor_flush())
+    watch_task = asyncio.create_task(watch_spaces())
     
     yield
     
     # Shutdown
-    cleanup_task.cancel()
+    watch_task.cancel()
+    cursor_task.cancel()
+    flush_task.cancel()
+    # Let an in-flight batch requeue itself before the final flush
+    try:
+        await flush_task
+    except asyncio.CancelledError:
+        pass
+    await flush_pending_writes()
     await close_mongodb_connection()
 
 
@@ -113,7 +314,8 @@ app = FastAPI(
     title="CodeCollab API",
     description="Real-time code sharing and collaboration",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -124,7 +326,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Small JSON bodies barely shrink; WebSocket traffic uses permessage-deflate instead
+app.add_middleware(GZipMiddleware, minimum_size=4096)
 
 
 # REST API Endpoints
@@ -138,7 +341,7 @@ async def root():
     }
 
 
-@app.post("/api/spaces", response_model=SpaceResponse)
+@app.post("/api/spaces")
 async def create_new_space(space_data: SpaceCreate):
     """Create a new code space"""
     space_id = str(uuid.uuid4())[:8]  # Short UUID for cleaner URLs
@@ -149,18 +352,23 @@ async def create_new_space(space_data: SpaceCreate):
         initial_code=space_data.initial_code
     )
     
-    invite_link = f"{FRONTEND_URL}/space/{space_id}"
+    manager.cache_space(space_doc)
     
-    return SpaceResponse(
-        space_id=space_id,
-        language=space_doc["language"],
-        code=space_doc["code"],
-        created_at=space_doc["created_at"],
-        invite_link=invite_link
+    invite_link = _INVITE_PREFIX + space_id
+    
+    return Response(
+        content=msgspec.json.encode(SpaceResponse(
+            space_id=space_id,
+            language=space_doc["language"],
+            code=space_doc["code"],
+            created_at=space_doc["created_at"],
+            invite_link=invite_link
+        )),
+        media_type="application/json"
     )
 
 
-@app.get("/api/spaces/{space_id}", response_model=SpaceResponse)
+@app.get("/api/spaces/{space_id}")
 async def get_space_details(space_id: str):
     """Get details of a specific space"""
     space = await get_space(space_id)
@@ -168,20 +376,28 @@ async def get_space_details(space_id: str):
     if not space:
         raise HTTPException(status_code=404, detail="Space not found")
     
-    invite_link = f"{FRONTEND_URL}/space/{space_id}"
+    invite_link = _INVITE_PREFIX + space_id
     
-    return SpaceResponse(
-        space_id=space["space_id"],
-        language=space["language"],
-        code=space["code"],
-        created_at=space["created_at"],
-        invite_link=invite_link
+    return Response(
+        content=msgspec.json.encode(SpaceResponse(
+            space_id=space["space_id"],
+            language=space["language"],
+            code=space["code"],
+            created_at=space["created_at"],
+            invite_link=invite_link
+        )),
+        media_type="application/json"
     )
 
 
 @app.delete("/api/spaces/{space_id}")
 async def delete_space_endpoint(space_id: str):
     """Delete a space"""
+    manager.space_cache.pop(space_id, None)
+    manager.space_snapshot_bytes.pop(space_id, None)
+    manager.last_language.pop(space_id, None)
+    manager.pending_code.pop(space_id, None)
+    manager.pending_lang.pop(space_id, None)
     deleted = await delete_space(space_id)
     
     if not deleted:
@@ -193,9 +409,7 @@ async def delete_space_endpoint(space_id: str):
 @app.get("/api/spaces/{space_id}/users")
 async def get_active_users_count(space_id: str):
     """Get count of active users in a space"""
-    space = await get_space(space_id)
-    
-    if not space:
+    if not await space_exists(space_id):
         raise HTTPException(status_code=404, detail="Space not found")
     
     active_count = manager.get_active_users(space_id)
@@ -210,11 +424,17 @@ async def get_active_users_count(space_id: str):
 @app.websocket("/ws/{space_id}")
 async def websocket_endpoint(websocket: WebSocket, space_id: str):
     """WebSocket endpoint for real-time code synchronization"""
-    # Check if space exists
-    space = await get_space(space_id)
-    if not space:
-        await websocket.close(code=4004, reason="Space not found")
-        return
+    # Check if space exists, preferring the in-process cache
+    space = manager.space_cache.get(space_id)
+    if space is None:
+        space = await fetch_space(space_id)
+        if not space:
+            await websocket.close(code=4004, reason="Space not found")
+            return
+        space = manager.cache_space(space)
+    manager.last_language.setdefault(
+        space_id, manager.latest_language(space_id, space["language"])
+    )
     
     # Generate unique user ID for this connection
     user_id = str(uuid.uuid4())[:8]
@@ -222,15 +442,9 @@ async def websocket_endpoint(websocket: WebSocket, space_id: str):
     await manager.connect(websocket, space_id, user_id)
     
     try:
-        # Send initial state to new user
-        await websocket.send_json({
-            "type": "init",
-            "space_id": space_id,
-            "user_id": user_id,
-            "code": space["code"],
-            "language": space["language"],
-            "active_users": manager.get_active_users(space_id)
-        })
+        # Send initial state to new user, picking up edits made during the accept
+        space = manager.space_cache.get(space_id) or manager.cache_space(space)
+        await websocket.send_bytes(manager.init_message(space, user_id))
         
         # Notify others that a new user joined
         await manager.broadcast(
@@ -245,18 +459,18 @@ async def websocket_endpoint(websocket: WebSocket, space_id: str):
         
         # Listen for messages
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            raw = await websocket.receive()
+            if raw["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(raw.get("code", 1000))
+            data = raw.get("bytes")
+            message = orjson.loads(data if data is not None else raw["text"])
             
             message_type = message.get("type")
             
             if message_type == "code_change":
                 new_code = message.get("code", "")
-                now = time.time()
-                last = manager.last_db_write.get(space_id, 0)
-                if now - last >= 0.5:
-                    await update_space_code(space_id, new_code)
-                    manager.last_db_write[space_id] = now
+                manager.pending_code[space_id] = new_code
+                manager.update_cached_space(space_id, code=new_code)
                 
                 await manager.broadcast(
                     space_id,
@@ -270,7 +484,11 @@ async def websocket_endpoint(websocket: WebSocket, space_id: str):
             
             elif message_type == "language_change":
                 new_language = message.get("language", "python")
-                await update_space_language(space_id, new_language)
+                # Skip the write when the language hasn't actually changed
+                if manager.last_language.get(space_id) != new_language:
+                    manager.last_language[space_id] = new_language
+                    manager.pending_lang[space_id] = new_language
+                    manager.update_cached_space(space_id, language=new_language)
                 
                 await manager.broadcast(
                     space_id,
@@ -283,15 +501,7 @@ async def websocket_endpoint(websocket: WebSocket, space_id: str):
                 )
             
             elif message_type == "cursor_move":
-                await manager.broadcast(
-                    space_id,
-                    {
-                        "type": "cursor_move",
-                        "user_id": user_id,
-                        "cursor_position": message.get("cursor_position", {})
-                    },
-                    exclude=websocket
-                )
+                manager.pending_cursors[(space_id, user_id)] = message.get("cursor_position", {})
     
     except WebSocketDisconnect:
         await manager.disconnect(websocket, space_id)
@@ -311,4 +521,14 @@ async def websocket_endpoint(websocket: WebSocket, space_id: str):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_per_message_deflate=True,
+        # Rooms are tracked per process; WORKERS > 1 needs MongoDB as a replica set
+        workers=int(os.getenv("WORKERS", "1"))
+    )
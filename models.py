@@ -1,5 +1,6 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List
+import msgspec
+from pydantic import BaseModel
+from typing import Optional
 from datetime import datetime
 
 
@@ -9,8 +10,8 @@ class SpaceCreate(BaseModel):
     initial_code: str = ""
 
 
-class SpaceResponse(BaseModel):
-    """Model for space API responses"""
+class SpaceResponse(msgspec.Struct):
+    """Model for space API responses, encoded directly with msgspec"""
     space_id: str
     language: str
     code: str
@@ -44,4 +45,3 @@ class SpaceDocument(BaseModel):
     language: str
     created_at: datetime
     last_updated: datetime
-    active_users: List[str] = Field(default_factory=list)